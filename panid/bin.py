@@ -2,8 +2,6 @@ from pathlib import Path
 import sys
 import logging
 
-from panid.panid import panid
-
 log = logging.getLogger(__name__)
 
 def bin(args = None):
@@ -23,6 +21,9 @@ def bin(args = None):
         for h in root_logger.handlers:
             h.setLevel(logging.DEBUG)
 
+    # Imported here so that `--help` does not pay for importing pandas
+    from panid.panid import panid
+
     log.debug(f"Starting PanID with args {args}")
 
     out_stream = args.output.open("w+") if args.output else sys.stdout
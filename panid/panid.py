@@ -1,16 +1,16 @@
 from typing import TextIO, Self, Callable
 from enum import StrEnum, Enum, auto
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
 import logging
 from pathlib import Path
 import time
 import os
-from io import BytesIO
-import shutil
-from functools import reduce
-from copy import copy
+from functools import cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 import requests
@@ -35,21 +35,28 @@ def gen_xml_query(attributes: list[str]) -> str:
     return BASE_XML.format("\n".join(queries))
 
 BIOMART = "https://asia.ensembl.org/biomart/martservice"
-BIOMART_XML_REQUESTS = {
-    "entrez": gen_xml_query(["ensembl_gene_id_version", "entrezgene_id"]),
-    "refseq": gen_xml_query(
-        [
-            "ensembl_gene_id_version",
-            "ensembl_transcript_id_version",
-            "refseq_mrna",
-            "refseq_ncrna"
-        ]
-    ),
-    "symbols": gen_xml_query(["ensembl_gene_id_version", "hgnc_id", "hgnc_symbol"])
+BIOMART_ATTRIBUTES = {
+    "entrez": ["ensembl_gene_id_version", "entrezgene_id"],
+    "refseq": [
+        "ensembl_gene_id_version",
+        "ensembl_transcript_id_version",
+        "refseq_mrna",
+        "refseq_ncrna"
+    ],
+    "symbols": ["ensembl_gene_id_version", "hgnc_id", "hgnc_symbol"]
 }
 
-def lmap(*args, **kwargs):
-    return list(map(*args, **kwargs))
+CACHE_DIR = Path("/var/tmp/panid_cache")
+
+@cache
+def biomart_query(key: str) -> str:
+    """Get the XML query for one of the `BIOMART_ATTRIBUTES` keys
+
+    The query is built on first use, and reused afterwards.
+    """
+    return gen_xml_query(BIOMART_ATTRIBUTES[key])
+
+CONVERSION_REGEX = re.compile(r"(.+?):(.+?)([+>])(.+?):(.+)")
 
 class IdType(StrEnum):
     ENSG_VERSION = auto()
@@ -61,6 +68,18 @@ class IdType(StrEnum):
     HGNC_ID = auto()
     HGNC_SYMBOL = auto()
 
+# The BioMart table that has each type of ID. `None` means that all of them do.
+ID_SOURCES = {
+    IdType.ENSG_VERSION: None,
+    IdType.ENSG: None,
+    IdType.ENST_VERSION: "refseq",
+    IdType.ENST: "refseq",
+    IdType.NCBI_GENE_ID: "entrez",
+    IdType.REFSEQ_RNA_ID: "refseq",
+    IdType.HGNC_ID: "symbols",
+    IdType.HGNC_SYMBOL: "symbols",
+}
+
 class Symbol(Enum):
     ADD = "+"
     REPLACE = ">"
@@ -72,6 +91,13 @@ class Conversion:
     to: str
     to_type: IdType
     additive: bool
+    # The ID types as plain strings, to use as column labels
+    original_col: str = field(init=False, repr=False, compare=False)
+    to_col: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.original_col = IdType(self.original_type).value
+        self.to_col = IdType(self.to_type).value
 
     @staticmethod
     def from_string(raw: str) -> Self:
@@ -85,25 +111,24 @@ class Conversion:
             - `<symbol>` either `+` or `>` to either preserve (`+`) or replace
               `>` the input column.
         """
-        deconstructor = re.compile(r"(.+?):(.+?)(\+|>)(.+?):(.+?)$")
+        res = CONVERSION_REGEX.fullmatch(raw)
+        if res is None:
+            raise ValueError(f"Invalid input conversion string: '{raw}'")
+
+        original, original_type, symbol, to, to_type = res.groups()
 
-        res = deconstructor.match(raw)
-        
         try:
-            original = res.group(1)
-            original_type = IdType(res.group(2))
-            symbol = Symbol(res.group(3))
-            to = res.group(4)
-            to_type = IdType(res.group(5))
-        except Exception as e:
-            log.error(f"Invalid input conversion string: {e}")
+            original_type = IdType(original_type)
+            to_type = IdType(to_type)
+        except ValueError as e:
+            raise ValueError(f"Invalid ID type in conversion string '{raw}': {e}") from e
 
         return Conversion(
             original=original,
             original_type=original_type,
             to=to,
             to_type=to_type,
-            additive=(symbol == Symbol.ADD)
+            additive=(Symbol(symbol) == Symbol.ADD)
         )
 
 class CachedData:
@@ -125,7 +150,7 @@ class CachedData:
     @property
     def is_timed_out(self) -> bool:
         try:
-            diff = self._location.lstat().st_mtime - time.time()
+            diff = time.time() - self._location.lstat().st_mtime
         except FileNotFoundError:
             # If there is no file, it's timed out.
             return True
@@ -147,14 +172,16 @@ class CachedData:
         with self._location.open("rb" if self._binary else "r") as stream:
             return self._loader(stream)
 
-def pbar_get(url: str, params: dict = {}, disable: bool = False) -> BytesIO:
-    """A requests.get() call with an added download bar
+@contextmanager
+def pbar_get_stream(url: str, params: dict = {}, disable: bool = False):
+    """A streaming requests.get() call with an added download bar
 
     The bar is suppressed if the log has an effective level of more than 20
     - anything greater than INFO - so the program runs silently if we don't want
     logging.
 
-    Raises Abort, killing Daedalus if the download fails. This is intended.
+    The response is not buffered: the yielded stream reads directly from the
+    socket, so it can be passed as-is to a parser (e.g. `pd.read_table`).
 
     Tries to estimate download sizes from the response headers.
 
@@ -164,164 +191,299 @@ def pbar_get(url: str, params: dict = {}, disable: bool = False) -> BytesIO:
         disable (bool, optional): Disable the progress bar?. Defaults to False.
 
     Raises:
-        Abort: If the request failed.
+        RuntimeError: If the request failed.
 
-    Returns:
-        BytesIO: The downloaded data, as bytes wrapped in a BytesIO object.
+    Yields:
+        The raw response stream, wrapped by the download bar.
     """
-    resp = requests.get(url=url, params=params, stream=True)
-
-    # Show only if we can show INFOs
-    disable = disable or log.getEffectiveLevel() > 20
-
-    if resp.status_code > 299 or resp.status_code < 200:
-        log.error(
-            f"Request got response {resp.status_code} -- {resp.reason}. Aborting."
-        )
-        raise RuntimeError
-
-    log.info(f"Retrieving response from {url}...")
-    size = int(resp.headers.get("Content-Length", 0))
-
-    desc = "[Unknown file size]" if size == 0 else ""
-    bytes = BytesIO()
-    # I add some delay so the logging does not get (too) mangled up.
-    # The download bars are there just to check on very long download tasks,
-    # like from biomart.
-    with tqdm.wrapattr(
-        resp.raw, "read", total=size, desc=desc, disable=disable
-    ) as read_raw:
-        shutil.copyfileobj(read_raw, bytes)
-
-    # Reset the pointer after we've written all the data
-    bytes.seek(0)
-    return bytes
-
-
-def retrieve_biomart() -> dict[pd.DataFrame]:
-    """Retrieve data from biomart.
-
-    Acts upon all biomart URLs. The columns are hard-coded in.
-
-    TODO: It might be possible to act on the XMLs to have the colnames arrive
-    with the data.
-
-    Returns:
-        DataDict: The dictionary with the downloaded data.
-    """
-    log.info("Starting to retrieve from BioMart.")
-
-    result = {}
-    for key, value in BIOMART_XML_REQUESTS.items():
-        log.info(f"Attempting to retrieve {key}...")
-
-        data = pbar_get(url=BIOMART, params={"query": value})
-
-        log.info("Casting response...")
+    with requests.get(url=url, params=params, stream=True) as resp:
+        # Show only if we can show INFOs
+        disable = disable or log.getEffectiveLevel() > 20
+
+        if resp.status_code > 299 or resp.status_code < 200:
+            log.error(
+                f"Request got response {resp.status_code} -- {resp.reason}. Aborting."
+            )
+            raise RuntimeError
+
+        log.info(f"Retrieving response from {url}...")
+        size = int(resp.headers.get("Content-Length", 0))
+
+        desc = "[Unknown file size]" if size == 0 else ""
+        # The raw stream does not undo any gzip/deflate encoding by itself
+        resp.raw.decode_content = True
+        # The download bars are there just to check on very long download tasks,
+        # like from biomart.
+        with tqdm.wrapattr(
+            resp.raw, "read", total=size, desc=desc, disable=disable
+        ) as read_raw:
+            yield read_raw
+
+
+def retrieve_biomart_table(key: str, query: str) -> pd.DataFrame:
+    """Retrieve a single table from biomart, with standardized column names."""
+    log.info(f"Attempting to retrieve {key}...")
+
+    with pbar_get_stream(url=BIOMART, params={"query": query}) as data:
         # The downloaded frames are sometimes big, so typing of the cols can
         # be hard. See the docs for why low_memory is needed here.
         # Not like it makes a real difference, memory-wise.
         df = pd.read_table(data, sep="\t", header=0, low_memory=False)
 
-        result[key] = df
-
-        # I don't want to deal with THe rANdom CaPItaLizATIon ThAt biOMarT uSEs
-        # so I just standardize all colnames here
-        def standardize_col(x: str):
-            return x.lower().strip().replace(" ", "_")
-
-        df.columns = lmap(standardize_col, df.columns)
-
-    log.info("Got all necessary data from BioMart.")
+    # I don't want to deal with THe rANdom CaPItaLizATIon ThAt biOMarT uSEs
+    # so I just standardize all colnames here
+    df.columns = df.columns.str.lower().str.strip().str.replace(" ", "_")
 
-    return result
+    log.info(f"Retrieved {key}.")
 
-def drop_version(id: str) -> str:
-    return ".".join(id.split(".")[:-1])
+    return df
 
-def fetch_id_data() -> pd.DataFrame:
-    """Fetch IDs from biomart"""
-    data = retrieve_biomart()
-
-    # collapse all the biomart frames
-    frames = data.values()
-    merged = reduce(
-            lambda x, y: pd.merge(x, y, how="outer", on="gene_stable_id_version"),
-            frames
-        )
+def drop_version(ids: pd.Series) -> pd.Series:
+    """Drop the trailing `.<version>` from a series of versioned IDs"""
+    return ids.str.rsplit(".", n=1).str[0]
 
+def clean_biomart_table(df: pd.DataFrame) -> pd.DataFrame:
+    """Clean up a table from `retrieve_biomart_table` to use our ID names"""
     # Run some cleanup since the colnames are pretty bad
-    merged.rename(
+    df = df.rename(
         columns = {
             "gene_stable_id_version": "ensg_version",
             "ncbi_gene_(formerly_entrezgene)_id": "ncbi_gene_id",
             "transcript_stable_id_version": "enst_version",
             "refseq_mrna_id": "refseq_rna_id"
         },
-        inplace=True,
     )
 
     # Fuse the `refseq_mrna_id` and `refseq_ncrna_id` columns
     # since they do not conflict
-    merged["refseq_rna_id"] = merged["refseq_rna_id"].fillna(merged["refseq_ncrna_id"])
-    merged.drop(columns=["refseq_ncrna_id"], inplace=True)
+    if "refseq_ncrna_id" in df.columns:
+        df["refseq_rna_id"] = df["refseq_rna_id"].fillna(df["refseq_ncrna_id"])
+        df = df.drop(columns=["refseq_ncrna_id"])
 
-    # bloat the "ensg" column
-    merged["ensg"] = lmap(drop_version, merged["ensg_version"].tolist())
-    merged["enst"] = lmap(drop_version, merged["enst_version"].tolist())
+    if "enst_version" in df.columns:
+        df["enst"] = drop_version(df["enst_version"])
 
-    return merged
+    # The NCBI IDs are parsed as floats (they have missing values), but the
+    # input is read as strings, so we store them as integer strings to match.
+    if "ncbi_gene_id" in df.columns:
+        ids = df["ncbi_gene_id"].astype("Int64")
+        df["ncbi_gene_id"] = ids.astype(str).where(ids.notna())
 
+    # The IDs repeat a lot, so storing them as categories saves a lot of
+    # memory, and joins and deduplications can work on the integer codes.
+    for col in df.columns:
+        df[col] = df[col].astype("category")
 
-def panid_convert(input: pd.DataFrame, conversion: Conversion, id_table: pd.DataFrame) -> pd.DataFrame:
-    selection = id_table[[conversion.to_type.value, conversion.original_type.value]]
-    # If the target column (the one to merge) has missing data, it's best to
-    # simply drop the NAs here, since the merge would re-add them.
-    # If we do not, the selection might have entries like this:
-    # col_one col_two
-    #     aaa     bbb
-    #     aaa      NA
-    # (since it derives from a much larger frame), and we would get these
-    # duplicated values in the resulting dataframe.
-    # So, we just drop the NAs in the additional column.
-    selection = selection.dropna(axis=0, subset=conversion.to_type.value)
-    selection = selection.rename(columns = {conversion.original_type.value : conversion.original})
-    selection = selection.drop_duplicates()
-    
-    merged = input.merge(
-        selection,
-        how = "left"
+    return df
+
+def biomart_cache(key: str) -> CachedData:
+    """Get the cache of one of the `BIOMART_ATTRIBUTES` tables
+
+    Each table is cached in its own file, so it can be refreshed (and
+    downloaded) only if it is needed.
+    """
+    def saver(conn):
+        df = clean_biomart_table(retrieve_biomart_table(key, biomart_query(key)))
+        df.to_parquet(conn, index=False, compression="zstd")
+
+    return CachedData(
+        location=CACHE_DIR / f"{key}.parquet",
+        loader=pd.read_parquet,
+        saver=saver,
+        binary=True
     )
-    merged = merged.drop_duplicates()
-    
-    if not conversion.additive:
-        merged = merged.drop(columns=[conversion.original])
 
-    merged = merged.rename(columns={conversion.to_type: conversion.to})
+def biomart_keys(conversions: list[Conversion]) -> list[str]:
+    """Get the keys of the BioMart tables needed to apply some conversions"""
+    needed = set()
+    for conv in conversions:
+        needed.update([ID_SOURCES[conv.original_type], ID_SOURCES[conv.to_type]])
+    needed.discard(None)
+
+    # All tables have the gene IDs, so any one of them will do if we need
+    # nothing else.
+    if not needed:
+        return [next(iter(BIOMART_ATTRIBUTES))]
+
+    return [key for key in BIOMART_ATTRIBUTES if key in needed]
+
+def fetch_id_data(keys: list[str] | None = None) -> pd.DataFrame:
+    """Fetch IDs from biomart
+
+    Only the tables in `keys` (all of them by default) are loaded from the
+    cache, or downloaded if the cache is missing or timed out.
+    """
+    keys = keys or list(BIOMART_ATTRIBUTES)
+    caches = [biomart_cache(key) for key in keys]
+
+    # The tables are independent, so they can be loaded (or downloaded) all
+    # at once.
+    with ThreadPoolExecutor(max_workers=len(caches)) as pool:
+        data = list(pool.map(lambda x: x.data, caches))
+
+    # collapse all the biomart frames in a single join on the gene IDs.
+    # If the IDs are unique in every frame, pandas aligns them all at once,
+    # else it falls back to joining them one after the other.
+    frames = [frame.set_index("ensg_version") for frame in data]
+    if len(frames) == 1:
+        merged = frames[0].reset_index()
+    else:
+        merged = frames[0].join(frames[1:], how="outer").reset_index()
+
+    # bloat the "ensg" column
+    merged["ensg"] = drop_version(merged["ensg_version"])
+
+    for col in ["ensg_version", "ensg"]:
+        merged[col] = merged[col].astype("category")
 
     return merged
 
 
-def panid(input_stream: TextIO, output_stream: TextIO, conversions: list[Conversion]):
-    cache = CachedData(
-        location=Path("/var/tmp/panid_cache/ID_data.csv"),
-        loader=pd.read_csv,
-        saver=lambda conn: fetch_id_data().to_csv(conn, index=False)
-    )
+def lookup_label(to_col: str) -> str:
+    """Get the label of the `to_col` IDs in a lookup made by `id_lookup`
 
-    data: pd.DataFrame = cache.data
+    The label cannot clash with the input columns, so the lookup can be
+    joined to any input. `panid_convert` renames it to the output name.
+    """
+    return f"__panid_lookup_{to_col}__"
 
-    input_data = pd.read_csv(input_stream)
-    conversions = [Conversion.from_string(x) for x in conversions]
 
-    converted_data = input_data
-    for i, conv in enumerate(conversions):
-        log.info(f"Applying conversion {i + 1}...")
-        if conv.original not in converted_data.columns:
-            raise ValueError(f"\t-{conv.original} not in input columns: {input_data.columns}")
-        converted_data = panid_convert(converted_data, conv, copy(data))
+def id_lookup(id_table: pd.DataFrame, original_col: str, *to_cols: str) -> pd.DataFrame:
+    """Build a lookup frame to convert `original_col` IDs to `to_cols` IDs
 
-    converted_data = converted_data.drop_duplicates()
+    The columns are the plain string ID types (see `Conversion.original_col`).
+    The lookup is indexed by the `original_col` IDs, so it can be built once
+    and reused to join many input frames without hashing the ID table again.
+
+    The target columns are labelled with `lookup_label`.
+    If more than one `to_cols` is given, the lookup has one column per type,
+    with all the combinations of the target IDs for each original ID - the
+    same rows that converting to each type one after the other would give.
+    """
+    lookups = []
+    for to_col in to_cols:
+        selection = id_table[[to_col, original_col]]
+        # If the target column (the one to merge) has missing data, it's best to
+        # simply drop the NAs here, since the merge would re-add them.
+        # If we do not, the selection might have entries like this:
+        # col_one col_two
+        #     aaa     bbb
+        #     aaa      NA
+        # (since it derives from a much larger frame), and we would get these
+        # duplicated values in the resulting dataframe.
+        # So, we just drop the NAs in the additional column.
+        # IDs that are missing in the original column can never be matched, so
+        # we drop them too.
+        selection = selection.dropna(axis=0, subset=[to_col, original_col])
+        selection = selection.drop_duplicates()
+        selection = selection.rename(columns={to_col: lookup_label(to_col)})
+
+        lookups.append(selection.set_index(original_col))
+
+    if len(lookups) == 1:
+        return lookups[0]
+
+    return lookups[0].join(lookups[1:], how="outer")
+
+
+def group_conversions(conversions: list[Conversion]) -> list[list[Conversion]]:
+    """Group back-to-back conversions that can be applied with a single join
+
+    Consecutive conversions are grouped if they start from the same column
+    with the same ID type, go to different ID types, and all but the last one
+    keep the original column (so the next ones can still use it).
+    """
+    groups = []
+    for conv in conversions:
+        if groups:
+            last = groups[-1][-1]
+            if (
+                last.original == conv.original
+                and last.original_type == conv.original_type
+                and last.additive
+                and last.to != last.original
+                and conv.to_col not in [x.to_col for x in groups[-1]]
+            ):
+                groups[-1].append(conv)
+                continue
+        groups.append([conv])
+
+    return groups
+
+
+def panid_convert(input: pd.DataFrame, conversions: list[Conversion], lookup: pd.DataFrame) -> pd.DataFrame:
+    """Apply a group of conversions to the input, using a lookup made by `id_lookup`
+
+    The conversions should all start from the same column, as grouped by
+    `group_conversions`.
+    """
+    merged = input.join(lookup, on=conversions[0].original, how="left")
+
+    if not conversions[-1].additive:
+        merged = merged.drop(columns=[conversions[-1].original])
+
+    merged = merged.rename(
+        columns={lookup_label(conv.to_col): conv.to for conv in conversions}
+    )
+
+    return merged
 
-    converted_data.to_csv(output_stream, index=False)
 
+def panid(
+    input_stream: TextIO,
+    output_stream: TextIO,
+    conversions: list[Conversion],
+    chunksize: int = 100_000
+):
+    # With Copy-on-Write, the selections, renames and drops below share the
+    # data with their parent frames instead of copying it each time.
+    # The option is only set here, so callers' pandas code is not affected.
+    with pd.option_context("mode.copy_on_write", True):
+        conversions = [Conversion.from_string(x) for x in conversions]
+
+        data: pd.DataFrame = fetch_id_data(biomart_keys(conversions))
+
+        groups = group_conversions(conversions)
+        # The lookups are built once here and shared by all the chunks
+        lookups = {}
+        for group in groups:
+            key = (group[0].original_col, *[conv.to_col for conv in group])
+            if key not in lookups:
+                lookups[key] = id_lookup(data, *key)
+
+        log.info(f"Applying {len(conversions)} conversions in {len(groups)} groups...")
+
+        # The input is read and converted in chunks, so memory use stays bounded
+        # by the chunk size and not by the size of the input.
+        # Duplicates might span more than one chunk, so we keep the hashes of the
+        # rows we have already written out and skip them if we see them again.
+        # All the columns are hashed: rows with the same IDs might still differ
+        # in the other input columns, and those must be kept.
+        seen_rows = set()
+        # Everything is read as strings: if each chunk inferred its own types,
+        # the same value could be written differently (e.g. `1` or `1.0`)
+        # depending on which chunk it ends up in.
+        reader = pd.read_csv(input_stream, chunksize=chunksize, dtype=str)
+        for chunk_n, input_data in enumerate(reader):
+            log.debug(f"Processing chunk {chunk_n + 1}...")
+            converted_data = input_data
+            for group in groups:
+                original = group[0].original
+                if original not in converted_data.columns:
+                    raise ValueError(f"\t-{original} not in input columns: {input_data.columns}")
+                key = (group[0].original_col, *[conv.to_col for conv in group])
+                converted_data = panid_convert(converted_data, group, lookups[key])
+
+            # The same row hashes also find the duplicates inside the chunk, so
+            # we don't need a separate `drop_duplicates` pass.
+            # The membership test runs against the set row by row, so each chunk
+            # costs the same no matter how many rows we have already seen.
+            hashes = pd.util.hash_pandas_object(converted_data, index=False)
+            is_new = ~hashes.duplicated().to_numpy()
+            hashes = hashes.tolist()
+            is_new &= np.fromiter((h not in seen_rows for h in hashes), bool, len(hashes))
+            seen_rows.update(hashes)
+
+            converted_data[is_new].to_csv(
+                output_stream, index=False, header=(chunk_n == 0)
+            )
@@ -1,3 +1,5 @@
+from pytest import raises
+
 from panid.panid import Conversion, IdType
 
 conversion_tests = [
@@ -28,3 +30,7 @@ def test_conversion_parsing():
         print(f"Testing {string}")
         assert Conversion.from_string(string) == conversion
 
+def test_invalid_conversion_strings():
+    for string in ["ensg:ensg", "ensg:banana+ensgv:ensg_version", "ensg:ensg-ensgv:ensg_version"]:
+        with raises(ValueError):
+            Conversion.from_string(string)
@@ -1,20 +1,28 @@
 from pytest import mark
+from pathlib import Path
+import time
+import os
+from io import StringIO
 from panid import panid
 import pandas as pd
+from pandas.testing import assert_frame_equal, assert_series_equal
 
 slow = mark.skipif("not config.getoption('longrun')")
 
 def test_drop_version():
-    assert panid.drop_version("hello.there.nice.22") == "hello.there.nice"
+    ids = pd.Series(["hello.there.nice.22", "ENSG00000000003.16", None])
+    expected = pd.Series(["hello.there.nice", "ENSG00000000003", None])
+
+    assert_series_equal(panid.drop_version(ids), expected)
 
 @slow
 def test_biomart_retrieve():
-    data = panid.retrieve_biomart()
-    
-    # We can only do a loose check here
-    assert data.keys() == panid.BIOMART_XML_REQUESTS.keys()
-    for item in data.values():
-        assert isinstance(item, pd.DataFrame)
+    for key in panid.BIOMART_ATTRIBUTES:
+        data = panid.retrieve_biomart_table(key, panid.biomart_query(key))
+
+        # We can only do a loose check here
+        assert isinstance(data, pd.DataFrame)
+        assert "gene_stable_id_version" in data.columns
 
 EXPECTED_QUERY = """<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE Query>
@@ -31,3 +39,118 @@ def test_query_generator():
 
     assert query == EXPECTED_QUERY
 
+
+def test_convert_does_not_mutate_id_table():
+    id_table = pd.DataFrame({
+        "ensg": ["ENSG01", "ENSG01", "ENSG02"],
+        "hgnc_symbol": ["AAA", None, "BBB"],
+    })
+    original = id_table.copy()
+    input = pd.DataFrame({"gene": ["ENSG01", "ENSG02"]})
+
+    conversion = panid.Conversion.from_string("gene:ensg+symbol:hgnc_symbol")
+    lookup = panid.id_lookup(id_table, conversion.original_col, conversion.to_col)
+    panid.panid_convert(input, [conversion], lookup)
+
+    assert_frame_equal(id_table, original)
+
+def test_grouped_conversions_match_sequential():
+    id_table = pd.DataFrame({
+        "ensg": ["ENSG01", "ENSG01", "ENSG01", "ENSG02", "ENSG03"],
+        "hgnc_symbol": ["AAA", "AAA", "AAA", "BBB", None],
+        "refseq_rna_id": ["NM_1", "NM_2", None, None, "NM_3"],
+    })
+    input = pd.DataFrame({"gene": ["ENSG01", "ENSG02", "ENSG03", "ENSG04"]})
+    conversions = [
+        panid.Conversion.from_string("gene:ensg+symbol:hgnc_symbol"),
+        panid.Conversion.from_string("gene:ensg>refseq:refseq_rna_id"),
+    ]
+
+    groups = panid.group_conversions(conversions)
+    assert groups == [conversions]
+
+    lookup = panid.id_lookup(id_table, "ensg", *[c.to_col for c in conversions])
+    grouped = panid.panid_convert(input, conversions, lookup)
+
+    sequential = input
+    for conv in conversions:
+        lookup = panid.id_lookup(id_table, conv.original_col, conv.to_col)
+        sequential = panid.panid_convert(sequential, [conv], lookup)
+
+    assert_frame_equal(grouped.reset_index(drop=True), sequential.reset_index(drop=True))
+
+def test_cache_timeout(tmp_path: Path):
+    location = tmp_path / "data.txt"
+    location.write_text("cached")
+    cache = panid.CachedData(
+        location=location,
+        loader=lambda stream: stream.read(),
+        saver=lambda stream: stream.write("fresh"),
+        timeout_sec=604800
+    )
+
+    assert not cache.is_timed_out
+    assert cache.data == "cached"
+
+    eight_days_ago = time.time() - 8 * 24 * 60 * 60
+    os.utime(location, (eight_days_ago, eight_days_ago))
+
+    assert cache.is_timed_out
+    assert cache.data == "fresh"
+
+def test_biomart_keys():
+    def keys(*strings):
+        return panid.biomart_keys([panid.Conversion.from_string(x) for x in strings])
+
+    assert keys("a:ensg+b:hgnc_symbol") == ["symbols"]
+    assert keys("a:hgnc_id+b:enst", "a:ensg+b:ncbi_gene_id") == ["entrez", "refseq", "symbols"]
+    assert len(keys("a:ensg_version>a:ensg")) == 1
+
+def test_chunked_conversion(monkeypatch):
+    id_table = pd.DataFrame({
+        "ensg": ["ENSG01", "ENSG01", "ENSG02"],
+        "hgnc_symbol": ["AAA", "AAB", "BBB"],
+    })
+    monkeypatch.setattr(panid, "fetch_id_data", lambda keys: id_table)
+
+    # `score` is numeric with a blank cell, so it would be parsed as ints or
+    # floats depending on the chunk if the types were inferred per chunk.
+    input = "gene,other,score\nENSG01,x,1\nENSG02,y,\nENSG01,x,1\nENSG03,z,2\nENSG02,y,\n"
+    conversions = ["gene:ensg+symbol:hgnc_symbol"]
+
+    def run(**kwargs):
+        output = StringIO()
+        panid.panid(StringIO(input), output, conversions, **kwargs)
+        return output.getvalue()
+
+    chunked = run(chunksize=1)
+    whole = run()
+
+    assert chunked.count("gene,other,score,symbol") == 1
+    assert chunked.splitlines() == [
+        "gene,other,score,symbol",
+        "ENSG01,x,1,AAA",
+        "ENSG01,x,1,AAB",
+        "ENSG02,y,,BBB",
+        "ENSG03,z,2,",
+    ]
+    assert chunked == whole
+
+def test_convert_with_clashing_input_column():
+    id_table = pd.DataFrame({
+        "ensg": ["ENSG01", "ENSG02"],
+        "hgnc_symbol": ["AAA", "BBB"],
+    })
+    # The input already has a column named like the target ID type
+    input = pd.DataFrame({"gene": ["ENSG01", "ENSG02"], "hgnc_symbol": ["x", "y"]})
+
+    conversion = panid.Conversion.from_string("gene:ensg+sym:hgnc_symbol")
+    lookup = panid.id_lookup(id_table, conversion.original_col, conversion.to_col)
+    result = panid.panid_convert(input, [conversion], lookup)
+
+    expected = pd.DataFrame({
+        "gene": ["ENSG01", "ENSG02"],
+        "hgnc_symbol": ["x", "y"],
+        "sym": ["AAA", "BBB"],
+    })
+    assert_frame_equal(result, expected)